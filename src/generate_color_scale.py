@@ -1,116 +1,631 @@
-import pandas as pd
-from openpyxl import load_workbook
-from colormath.color_objects import LabColor, sRGBColor, HSLColor, LCHabColor
-from colormath.color_diff import delta_e_cie2000
-from colormath.color_conversions import convert_color
+import posixpath
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import fromstring, iterparse
+import argparse
+import colorsys
+import math
+import os
+import threading
 import numpy as np
+from scipy.spatial import cKDTree
 
-# Monkey-patch для numpy.asscalar, который был удален в новых версиях.
-# colormath 3.0.0 все еще его использует.
-if not hasattr(np, 'asscalar'):
-    np.asscalar = lambda x: x.item()
+# Numba не обязательна и импортируется только при первом расчете для одного
+# цвета (см. _compiled_de2000_batch)
 
-def get_rgb_from_lab(lab_color):
-    """Преобразует объект LabColor в кортеж RGB."""
-    srgb = convert_color(lab_color, sRGBColor)
-    # Ограничиваем значения в диапазоне 0-1 перед конвертацией
-    clamped_rgb = tuple(max(0, min(1, val)) for val in srgb.get_value_tuple())
-    return tuple(int(c * 255) for c in clamped_rgb)
+# Константы для прямого преобразования CIELAB -> sRGB.
+# LAB-координаты каталога заданы для D50 (как и LabColor в colormath по умолчанию);
+# sRGB определен для D65, поэтому адаптация Брэдфорда встроена в итоговую матрицу.
+_CIE_E = 216.0 / 24389.0
+_WHITE_D50 = np.array([0.96422, 1.00000, 0.82521])
+_WHITE_D65 = np.array([0.95047, 1.00000, 1.08883])
+_BRADFORD = np.array([
+    [0.8951, 0.2664, -0.1614],
+    [-0.7502, 1.7135, 0.0367],
+    [0.0389, -0.0685, 1.0296],
+])
+_XYZ_TO_LINEAR_SRGB = np.array([
+    [3.24071, -1.53726, -0.498571],
+    [-0.969258, 1.87599, 0.0415557],
+    [0.0556352, -0.203996, 1.05707],
+])
+_D50_TO_D65 = (np.linalg.inv(_BRADFORD)
+               @ np.diag((_BRADFORD @ _WHITE_D65) / (_BRADFORD @ _WHITE_D50))
+               @ _BRADFORD)
+_XYZ_D50_TO_LINEAR_SRGB = _XYZ_TO_LINEAR_SRGB @ _D50_TO_D65
 
-def get_hsl_from_lab(lab_color):
-    """Преобразует объект LabColor в кортеж HSL."""
-    hsl = convert_color(lab_color, HSLColor)
-    return hsl.get_value_tuple()
+def lab_to_lch(lab_arr):
+    """Преобразует LAB (..., 3) в LCH(ab): светлота, хрома и тон в градусах 0-360."""
+    lab_arr = np.asarray(lab_arr, dtype=np.float64)
+    lab_l, lab_a, lab_b = lab_arr[..., 0], lab_arr[..., 1], lab_arr[..., 2]
+    lch_h = np.degrees(np.arctan2(lab_b, lab_a))
+    lch_h = np.where(lch_h > 0, lch_h, lch_h + 360)
+    return np.stack([lab_l, np.hypot(lab_a, lab_b), lch_h], axis=-1)
 
-def extract_colors_from_excel(file_path):
+def _lab_to_srgb(lab_arr):
+    """
+    Преобразует массив LAB (N, 3) в sRGB (N, 3) с плавающей точкой.
+    Как и в colormath, отрицательные линейные компоненты обнуляются,
+    а значения больше 1 не ограничиваются.
+    """
+    lab_arr = np.asarray(lab_arr, dtype=np.float64)
+    fy = (lab_arr[..., 0] + 16.0) / 116.0
+    fx = fy + lab_arr[..., 1] / 500.0
+    fz = fy - lab_arr[..., 2] / 200.0
+    f = np.stack([fx, fy, fz], axis=-1)
+    xyz = np.where(f ** 3 > _CIE_E, f ** 3, (f - 16.0 / 116.0) / 7.787) * _WHITE_D50
+
+    linear_rgb = np.maximum(xyz @ _XYZ_D50_TO_LINEAR_SRGB.T, 0.0)
+    return np.where(
+        linear_rgb <= 0.0031308,
+        12.92 * linear_rgb,
+        1.055 * linear_rgb ** (1 / 2.4) - 0.055,
+    )
+
+def _srgb_to_u8(srgb):
+    """Ограничивает sRGB диапазоном 0-1 и переводит в uint8."""
+    return (np.clip(srgb, 0, 1) * 255).astype(np.uint8)
+
+def rgb_to_hex(rgb_u8):
+    """Преобразует массив RGB (N, 3) uint8 в список строк "#RRGGBB" за один tobytes()."""
+    flat = np.ascontiguousarray(rgb_u8, dtype=np.uint8).tobytes()
+    return ["#" + flat[i:i + 3].hex().upper() for i in range(0, len(flat), 3)]
+
+def lab_summary(lab_arr):
+    """
+    Сводка по массиву LAB (N, 3) за одно преобразование в sRGB:
+    {"rgb": ndarray (N, 3) uint8, "hex": ["#RRGGBB", ...], "hsl": [(H°, S, L), ...]}.
+    HSL считается, как и в colormath, по sRGB до ограничения сверху.
+    """
+    srgb = _lab_to_srgb(lab_arr)
+    hsl = []
+    for r, g, b in srgb.tolist():
+        h, l, s = colorsys.rgb_to_hls(r, g, b)
+        hsl.append((h * 360.0, s, l))
+    rgb = _srgb_to_u8(srgb)
+    return {"rgb": rgb, "hex": rgb_to_hex(rgb), "hsl": hsl}
+
+def _make_catalog(names, lab_rows):
+    """
+    Собирает каталог в виде структуры массивов: список имен, матрица LAB (N, 3) float32,
+    заранее посчитанные величины для CIEDE2000, специализированное под каталог
+    ядро CIEDE2000 и k-d дерево по LAB.
+    """
+    # float32 с запасом хватает для dE с двумя знаками и вдвое сокращает объем данных
+    lab_array = np.array(lab_rows, dtype=np.float32).reshape(-1, 3)
+    precomputed = precompute_catalog(lab_array)
+    return {
+        "names": names,
+        "lab": lab_array,
+        "precomputed": precomputed,
+        "kernel": make_de2000_kernel(lab_array, precomputed),
+        "tree": cKDTree(lab_array),
+    }
+
+_XLSX_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_XLSX_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Индексы нужных столбцов (с нуля): D - название, AQ/AS/AU - L*, a*, b*
+_NAME_COL, _L_COL, _A_COL, _B_COL = 3, 42, 44, 46
+_TARGET_COLS = frozenset((_NAME_COL, _L_COL, _A_COL, _B_COL))
+_LAST_TARGET_COL = max(_TARGET_COLS)
+
+def _column_index(cell_ref):
+    """Переводит буквы столбца из ссылки вида 'AQ17' в индекс с нуля."""
+    index = 0
+    for char in cell_ref:
+        if char.isdigit():
+            break
+        index = index * 26 + (ord(char) - 64)
+    return index - 1
+
+def _read_shared_strings(archive):
+    """Читает xl/sharedStrings.xml в список строк (с учетом rich text)."""
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    strings = []
+    with archive.open("xl/sharedStrings.xml") as stream:
+        for _, elem in iterparse(stream):
+            if elem.tag == _XLSX_MAIN_NS + "si":
+                # Фонетические подсказки (rPh) не входят в значение ячейки
+                for phonetic in elem.findall(_XLSX_MAIN_NS + "rPh"):
+                    elem.remove(phonetic)
+                strings.append("".join(t.text or "" for t in elem.iter(_XLSX_MAIN_NS + "t")))
+                elem.clear()
+    return strings
+
+def _find_sheet_path(archive, sheet_name):
+    """Возвращает путь XML-файла листа внутри архива или None."""
+    workbook = archive.read("xl/workbook.xml")
+    rels = archive.read("xl/_rels/workbook.xml.rels")
+    rel_id = None
+    for sheet in fromstring(workbook).iter(_XLSX_MAIN_NS + "sheet"):
+        if sheet.get("name") == sheet_name:
+            rel_id = sheet.get(_XLSX_REL_NS + "id")
+            break
+    if rel_id is None:
+        return None
+    for rel in fromstring(rels).iter(_XLSX_PKG_REL_NS + "Relationship"):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target.lstrip("/")
+            return posixpath.normpath(posixpath.join("xl", target))
+    return None
+
+def _cell_value(cell, shared_strings):
+    """Значение ячейки с теми же приведениями типов, что и в openpyxl."""
+    cell_type = cell.get("t", "n")
+    if cell_type == "inlineStr":
+        return "".join(t.text or "" for t in cell.iter(_XLSX_MAIN_NS + "t"))
+    value = cell.findtext(_XLSX_MAIN_NS + "v")
+    if value is None:
+        return None
+    if cell_type == "s":
+        return shared_strings[int(value)]
+    if cell_type == "n":
+        if "." in value or "E" in value or "e" in value:
+            return float(value)
+        return int(value)
+    if cell_type == "b":
+        return bool(int(value))
+    return value
+
+def _iter_sheet_rows(archive, sheet_path, shared_strings, min_row=1):
+    """
+    Потоково разбирает XML листа и для каждой строки (начиная с min_row)
+    возвращает словарь {индекс столбца: значение} только для нужных столбцов.
+    """
+    row_tag, cell_tag = _XLSX_MAIN_NS + "row", _XLSX_MAIN_NS + "c"
+    sheet_data = None
+    row_number = 0
+    with archive.open(sheet_path) as stream:
+        for event, elem in iterparse(stream, events=("start", "end")):
+            if event == "start":
+                if elem.tag == _XLSX_MAIN_NS + "sheetData":
+                    sheet_data = elem
+                continue
+            if elem.tag != row_tag:
+                continue
+
+            row_number = int(elem.get("r", row_number + 1))
+            if row_number >= min_row:
+                values = {}
+                col = -1
+                for cell in elem.iter(cell_tag):
+                    ref = cell.get("r")
+                    col = _column_index(ref) if ref else col + 1
+                    # Ячейки в строке упорядочены по столбцам: дальше AU искать нечего
+                    if col > _LAST_TARGET_COL:
+                        break
+                    if col in _TARGET_COLS:
+                        values[col] = _cell_value(cell, shared_strings)
+                yield values
+            # Освобождаем разобранные строки, чтобы память не росла
+            sheet_data.clear()
+
+# Суффикс кэша разобранного каталога рядом с Excel-файлом (см. extract_colors_from_excel)
+CATALOG_CACHE_SUFFIX = ".npz"
+# Версия формата кэша: увеличивается при любом изменении разбора каталога,
+# чтобы старые кэши не использовались
+CATALOG_CACHE_VERSION = 1
+
+def _load_catalog_cache(cache_path, source_stat):
+    """
+    Читает кэш каталога, если он записан той же версией разбора для той же
+    версии Excel-файла (совпадают время изменения и размер). Иначе, в том
+    числе если файл кэша поврежден, возвращает None.
+    """
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if (int(data["version"]) != CATALOG_CACHE_VERSION
+                    or int(data["mtime_ns"]) != source_stat.st_mtime_ns
+                    or int(data["size"]) != source_stat.st_size):
+                return None
+            return data["names"].tolist(), data["lab"]
+    except (FileNotFoundError, KeyError):
+        # Кэша нет или он записан старой версией без нужных полей
+        return None
+    except Exception as e:
+        # Поврежденный кэш (пустой, обрезанный и т.п.) - разбираем Excel заново
+        print(f"Кэш каталога {cache_path} не прочитан и будет создан заново: {e}")
+        return None
+
+def _save_catalog_cache(cache_path, source_stat, names, lab_rows):
+    """Сохраняет разобранный каталог; ошибки записи не мешают работе."""
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     names=np.array(names, dtype=str),
+                     lab=np.array(lab_rows, dtype=np.float32).reshape(-1, 3),
+                     version=CATALOG_CACHE_VERSION,
+                     mtime_ns=source_stat.st_mtime_ns,
+                     size=source_stat.st_size)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Не удалось сохранить кэш каталога: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def _parse_catalog_xlsx(file_path):
+    """
+    Разбирает лист 'Каталог Folio' и возвращает (names, lab_rows)
+    или None, если листа нет.
+    """
+    names = []
+    raw_lab = []
+    with zipfile.ZipFile(file_path) as archive:
+        sheet_path = _find_sheet_path(archive, 'Каталог Folio')
+        if sheet_path is None:
+            return None
+
+        shared_strings = _read_shared_strings(archive)
+
+        for row in _iter_sheet_rows(archive, sheet_path, shared_strings, min_row=3):
+            name = row.get(_NAME_COL)
+            l_val = row.get(_L_COL)
+            a_val = row.get(_A_COL)
+            b_val = row.get(_B_COL)
+
+            if name and l_val is not None and a_val is not None and b_val is not None:
+                names.append(str(name))
+                raw_lab.append((l_val, a_val, b_val))
+
+    # Все значения приводятся к числам одним проходом на уровне C
+    raw_lab = np.array(raw_lab, dtype=object).reshape(-1, 3)
+    try:
+        return names, raw_lab.astype(np.float64)
+    except (ValueError, TypeError):
+        pass
+
+    # Есть нечисловые значения: отбрасываем такие строки по одной
+    valid_names = []
+    lab_rows = []
+    for name, (l_val, a_val, b_val) in zip(names, raw_lab.tolist()):
+        try:
+            lab = (float(l_val), float(a_val), float(b_val))
+        except (ValueError, TypeError):
+            continue
+        valid_names.append(name)
+        lab_rows.append(lab)
+    return valid_names, lab_rows
+
+def extract_colors_from_excel(file_path, cache_path=None):
     """
     Извлекает данные о цветах из указанного Excel-файла,
     обрабатывая ссылки на общие строки и пропуская заголовки.
+
+    Файл .xlsx читается напрямую как zip-архив: XML листа разбирается
+    потоково, и из каждой строки берутся только столбцы D, AQ, AS, AU.
+    Результат кэшируется в cache_path (по умолчанию <файл>.xlsx.npz рядом
+    с файлом) и используется, пока Excel-файл не изменится.
+
+    Возвращает словарь {"names": [...], "lab": ndarray (N, 3) float32, ...}.
     """
-    all_colors = []
+    if cache_path is None:
+        cache_path = file_path + CATALOG_CACHE_SUFFIX
     try:
-        # data_only=True необходимо, чтобы openpyxl разрешал ссылки (shared strings)
-        workbook = load_workbook(filename=file_path, read_only=True, data_only=True)
-        
-        if 'Каталог Folio' not in workbook.sheetnames:
-            print("Лист 'Каталог Folio' не найден в файле.")
-            return []
-            
-        sheet = workbook['Каталог Folio']
+        source_stat = os.stat(file_path)
 
-        for row in sheet.iter_rows(min_row=3):
-            name = row[3].value
-            l_val = row[42].value
-            a_val = row[44].value
-            b_val = row[46].value
+        cached = _load_catalog_cache(cache_path, source_stat)
+        if cached is not None:
+            names, lab_array = cached
+            print(f"Успешно извлечено {len(names)} цветов из кэша {cache_path}.")
+            return _make_catalog(names, lab_array)
 
-            if name and l_val is not None and a_val is not None and b_val is not None:
-                try:
-                    lab = LabColor(float(l_val), float(a_val), float(b_val))
-                    all_colors.append({"name": str(name), "lab": lab})
-                except (ValueError, TypeError):
-                    continue
+        parsed = _parse_catalog_xlsx(file_path)
+        if parsed is None:
+            print("Лист 'Каталог Folio' не найден в файле.")
+            return _make_catalog([], [])
+        names, lab_rows = parsed
         
-        print(f"Успешно извлечено {len(all_colors)} цветов из файла.")
-        return all_colors
+        print(f"Успешно извлечено {len(names)} цветов из файла.")
 
     except Exception as e:
         print(f"Произошла ошибка при чтении Excel файла: {e}")
-        return []
+        return _make_catalog([], [])
+
+    _save_catalog_cache(cache_path, source_stat, names, lab_rows)
+    return _make_catalog(names, lab_rows)
 
-def find_closest_color_hybrid(target_lab, color_catalog, lightness_tolerance=5.0):
+def precompute_catalog(lab_array):
     """
-    Находит ближайший цвет по гибридному алгоритму:
-    1. Фильтрует каталог по близкой светлоте.
-    2. В отфильтрованной группе находит ближайший цвет по формуле CIEDE2000.
+    Заранее считает величины CIEDE2000, зависящие только от каталога.
+    Поправка G зависит от средней хромы пары цветов, поэтому a' и h'
+    по-прежнему вычисляются для каждого запроса.
     """
-    target_l = target_lab.lab_l
-    
-    # 1. Фильтрация по светлоте
-    filtered_catalog = [
-        color for color in color_catalog 
-        if abs(color['lab'].lab_l - target_l) <= lightness_tolerance
-    ]
-    
-    if not filtered_catalog:
-        # Если в допуске ничего не найдено, ищем по всему каталогу
-        filtered_catalog = color_catalog
+    a_sq = lab_array[:, 1] ** 2
+    b_sq = lab_array[:, 2] ** 2
+    return {
+        "L": lab_array[:, 0],
+        "a": lab_array[:, 1],
+        "b": lab_array[:, 2],
+        "a_sq": a_sq,
+        "b_sq": b_sq,
+        "C": np.hypot(lab_array[:, 1], lab_array[:, 2]),
+    }
 
-    if not filtered_catalog:
-        return None # Произойдет, только если исходный каталог пуст
+def _delta_e_cie2000(L1, a1, b1, C1, L2, a2, b2, a2_sq, b2_sq, C2, Kl=1, Kc=1, Kh=1):
+    """Общее ядро CIEDE2000 в формулировке colormath.color_diff_matrix."""
+    avg_Lp = (L1 + L2) / 2.0
 
-    # 2. Поиск ближайшего в отфильтрованной группе
-    return min(filtered_catalog, key=lambda color: delta_e_cie2000(target_lab, color['lab']))
+    avg_C1_C2 = (C1 + C2) / 2.0
 
-def generate_color_scale_html(ideal_scale, real_scale, filename="color_scale.html"):
-    """Генерирует HTML-файл для визуализации двух цветовых шкал."""
-    
-    def generate_strip(title, scale_data):
-        """Вспомогательная функция для генерации одной полосы градиента."""
-        strip_html = f"<h2>{title}</h2><div class='container'>"
-        for item in scale_data:
-            rgb = item['rgb']
-            lab_l, lab_a, lab_b = item['lab'].lab_l, item['lab'].lab_a, item['lab'].lab_b
-            hsl_h, hsl_s, hsl_l = item['hsl']
-            text_color = "black" if lab_l > 60 else "white"
-            
-            info_html = f"<p>LAB: {lab_l:.1f}, {lab_a:.1f}, {lab_b:.1f}</p>"
-            info_html += f"<p>HSL: {hsl_h:.0f}°, {hsl_s*100:.0f}%, {hsl_l*100:.0f}%</p>"
-            
-            if 'match_name' in item:
-                info_html += f"<p>Folio: {item['match_name']}</p>"
-                info_html += f"<p><small>dE2000: {item['delta_e']:.2f}</small></p>"
-
-            strip_html += f"""
-            <div class="color-band" style="background-color: rgb({rgb[0]}, {rgb[1]}, {rgb[2]}); color: {text_color};">
-                <div class="color-info">
-                    {info_html}
-                </div>
-            </div>"""
-        strip_html += "</div>"
-        return strip_html
+    G = 0.5 * (1 - np.sqrt(avg_C1_C2 ** 7.0 / (avg_C1_C2 ** 7.0 + 25.0 ** 7.0)))
+
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+
+    C1p = np.sqrt(a1p ** 2 + b1 ** 2)
+    C2p = np.sqrt((1.0 + G) ** 2 * a2_sq + b2_sq)
+    avg_C1p_C2p = (C1p + C2p) / 2.0
+
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p = np.where(h1p < 0, h1p + 360, h1p)
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p = np.where(h2p < 0, h2p + 360, h2p)
+
+    # np.where вместо умножения bool-маски на int: иначе результат
+    # повышается до float64 и ядро перестает работать в float32
+    avg_Hp = (h1p + h2p) / 2.0
+    avg_Hp = np.where(np.fabs(h1p - h2p) > 180, avg_Hp + 180, avg_Hp)
+
+    T = (1 - 0.17 * np.cos(np.radians(avg_Hp - 30))
+         + 0.24 * np.cos(np.radians(2 * avg_Hp))
+         + 0.32 * np.cos(np.radians(3 * avg_Hp + 6))
+         - 0.2 * np.cos(np.radians(4 * avg_Hp - 63)))
 
-    html_content = """
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = np.where(np.fabs(diff_h2p_h1p) > 180, diff_h2p_h1p + 360, diff_h2p_h1p)
+    delta_hp = np.where(h2p > h1p, delta_hp - 720, delta_hp)
+
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+    S_L = 1 + ((0.015 * (avg_Lp - 50) ** 2) / np.sqrt(20 + (avg_Lp - 50) ** 2.0))
+    S_C = 1 + 0.045 * avg_C1p_C2p
+    S_H = 1 + 0.015 * avg_C1p_C2p * T
+
+    delta_ro = 30 * np.exp(-(((avg_Hp - 275) / 25) ** 2.0))
+    R_C = np.sqrt(avg_C1p_C2p ** 7.0 / (avg_C1p_C2p ** 7.0 + 25.0 ** 7.0))
+    R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+    return np.sqrt(
+        (delta_Lp / (S_L * Kl)) ** 2 +
+        (delta_Cp / (S_C * Kc)) ** 2 +
+        (delta_Hp / (S_H * Kh)) ** 2 +
+        R_T * (delta_Cp / (S_C * Kc)) * (delta_Hp / (S_H * Kh)))
+
+def delta_e_cie2000_with_precomputed(target_lab, precomputed):
+    """
+    CIEDE2000 от target_lab (3,) до каталога, для которого уже вызван
+    precompute_catalog. Величины целевого цвета считаются здесь.
+    target_lab (..., 3) транслируется по ведущим осям массивов precomputed.
+    """
+    dtype = precomputed["L"].dtype
+    target_lab = np.asarray(target_lab, dtype=dtype)
+    L1, a1, b1 = target_lab[..., 0], target_lab[..., 1], target_lab[..., 2]
+    C1 = np.hypot(a1, b1)
+    return _delta_e_cie2000(
+        L1, a1, b1, C1,
+        precomputed["L"], precomputed["a"], precomputed["b"],
+        precomputed["a_sq"], precomputed["b_sq"], precomputed["C"])
+
+def _de2000_batch(L1, a1, b1, Lc, ac, bc, out):
+    """
+    Скалярное ядро CIEDE2000 (формулировка colormath) от одного цвета
+    до каталога, заданного столбцами Lc, ac, bc. Результат пишется в out.
+    С Numba цикл компилируется в один проход без промежуточных массивов.
+    """
+    C1 = math.hypot(a1, b1)
+    for i in range(Lc.shape[0]):
+        L2, a2, b2 = Lc[i], ac[i], bc[i]
+        avg_Lp = (L1 + L2) / 2.0
+        avg_C = (C1 + math.hypot(a2, b2)) / 2.0
+        avg_C7 = avg_C ** 7
+        G = 0.5 * (1.0 - math.sqrt(avg_C7 / (avg_C7 + 25.0 ** 7)))
+
+        a1p = (1.0 + G) * a1
+        a2p = (1.0 + G) * a2
+        C1p = math.sqrt(a1p * a1p + b1 * b1)
+        C2p = math.sqrt(a2p * a2p + b2 * b2)
+        avg_Cp = (C1p + C2p) / 2.0
+
+        h1p = math.degrees(math.atan2(b1, a1p))
+        if h1p < 0:
+            h1p += 360.0
+        h2p = math.degrees(math.atan2(b2, a2p))
+        if h2p < 0:
+            h2p += 360.0
+
+        avg_Hp = (h1p + h2p) / 2.0
+        if abs(h1p - h2p) > 180:
+            avg_Hp += 180.0
+
+        T = (1.0 - 0.17 * math.cos(math.radians(avg_Hp - 30))
+             + 0.24 * math.cos(math.radians(2 * avg_Hp))
+             + 0.32 * math.cos(math.radians(3 * avg_Hp + 6))
+             - 0.2 * math.cos(math.radians(4 * avg_Hp - 63)))
+
+        delta_hp = h2p - h1p
+        if abs(delta_hp) > 180:
+            delta_hp += 360.0
+        if h2p > h1p:
+            delta_hp -= 720.0
+
+        delta_Lp = L2 - L1
+        delta_Cp = C2p - C1p
+        delta_Hp = 2.0 * math.sqrt(C2p * C1p) * math.sin(math.radians(delta_hp) / 2.0)
+
+        S_L = 1.0 + (0.015 * (avg_Lp - 50) ** 2) / math.sqrt(20 + (avg_Lp - 50) ** 2)
+        S_C = 1.0 + 0.045 * avg_Cp
+        S_H = 1.0 + 0.015 * avg_Cp * T
+
+        delta_ro = 30.0 * math.exp(-(((avg_Hp - 275) / 25) ** 2))
+        avg_Cp7 = avg_Cp ** 7
+        R_C = math.sqrt(avg_Cp7 / (avg_Cp7 + 25.0 ** 7))
+        R_T = -2.0 * R_C * math.sin(2 * math.radians(delta_ro))
+
+        dL = delta_Lp / S_L
+        dC = delta_Cp / S_C
+        dH = delta_Hp / S_H
+        out[i] = math.sqrt(dL * dL + dC * dC + dH * dH + R_T * dC * dH)
+    return out
+
+# Скомпилированное ядро: None - Numba еще не загружалась, False - ее нет
+_de2000_compiled = None
+_de2000_compile_lock = threading.Lock()
+
+def _compiled_de2000_batch():
+    """
+    Лениво компилирует _de2000_batch через Numba при первом вызове.
+    Возвращает скомпилированную функцию или None, если Numba не установлена.
+
+    Ядро однопоточное (без parallel=True): его вызывают и из потоков
+    ThreadPoolExecutor, а вложенный параллелизм Numba в них может подвесить
+    процесс. Компиляция идет под блокировкой, чтобы потоки не собирали ядро дважды.
+    """
+    global _de2000_compiled
+    if _de2000_compiled is None:
+        with _de2000_compile_lock:
+            if _de2000_compiled is None:
+                try:
+                    import numba
+                except ImportError:
+                    _de2000_compiled = False
+                else:
+                    _de2000_compiled = numba.njit(fastmath=True, cache=True)(_de2000_batch)
+    return _de2000_compiled or None
+
+def make_de2000_kernel(lab_array, precomputed=None):
+    """
+    Специализирует CIEDE2000 (kL = kC = kH = 1) под конкретный каталог:
+    возвращает функцию kernel(target_lab, candidates=None), в которой уже
+    захвачены заранее посчитанные величины каталога и его столбцы LAB.
+
+    Без candidates считаются расстояния до всего каталога, иначе - только
+    до цветов с этими индексами. Для одного цвета (3,) при наличии Numba
+    используется скомпилированное ядро, для набора (..., 3) - NumPy
+    с трансляцией по форме candidates.
+    """
+    if precomputed is None:
+        precomputed = precompute_catalog(lab_array)
+    dtype = lab_array.dtype
+    columns = tuple(np.ascontiguousarray(lab_array[:, i]) for i in range(3))
+
+    def kernel(target_lab, candidates=None):
+        target_lab = np.asarray(target_lab, dtype=dtype)
+        compiled = _compiled_de2000_batch() if target_lab.ndim == 1 else None
+        if compiled is not None:
+            cols = columns if candidates is None else tuple(col[candidates] for col in columns)
+            L1, a1, b1 = target_lab
+            return compiled(L1, a1, b1, *cols, np.empty(len(cols[0]), dtype=dtype))
+
+        terms = precomputed
+        if candidates is not None:
+            terms = {key: values[candidates] for key, values in precomputed.items()}
+        return delta_e_cie2000_with_precomputed(target_lab, terms)
+
+    return kernel
+
+def catalog_lab_values(lab_row):
+    """
+    Возвращает LAB строки каталога (float32) как кортеж float с исходными
+    десятичными значениями из Excel: кратчайшее представление float32
+    совпадает с записанным в таблице числом, поэтому округление при выводе
+    не меняется.
+    """
+    return tuple(float(str(v)) for v in lab_row)
+
+def find_closest_colors_hybrid(target_labs, color_catalog, lightness_tolerance=5.0):
+    """
+    Точный гибридный алгоритм сразу для набора цветов (M, 3): матрица (M, N)
+    dE2000 до всего каталога считается одним вызовом, а фильтр по светлоте
+    применяется как маска (M, N). Строки без цветов в допуске ищут по всему
+    каталогу.
+
+    Возвращает пару массивов (M,): индексы найденных цветов в каталоге
+    и их dE2000, или (None, None), если каталог пуст.
+    """
+    lab_array = color_catalog["lab"]
+    if len(lab_array) == 0:
+        return None, None
+
+    target_labs = np.asarray(target_labs, dtype=np.float64).reshape(-1, 3)
+    delta_e = color_catalog["kernel"](target_labs[:, None, :])
+
+    in_tolerance = np.abs(lab_array[None, :, 0] - target_labs[:, None, 0]) <= lightness_tolerance
+    in_tolerance[~in_tolerance.any(axis=1)] = True
+    delta_e = np.where(in_tolerance, delta_e, np.inf)
+
+    best = np.argmin(delta_e, axis=1)
+    rows = np.arange(len(target_labs))
+    return best, delta_e[rows, best]
+
+# Меньшие наборы цветов быстрее обработать в одном потоке
+_PARALLEL_MIN_TARGETS = 1024
+
+def find_closest_colors_kdtree(target_labs, color_catalog, k=32, lightness_tolerance=5.0, workers=1):
+    """
+    Ускоренный вариант гибридного алгоритма сразу для набора цветов (M, 3):
+    1. Берет k ближайших по евклидову расстоянию в LAB цветов из k-d дерева.
+    2. Среди них оставляет цвета с близкой светлотой.
+    3. Точный подбор среди оставшихся по формуле CIEDE2000.
+    Если ни один из k соседей не попал в допуск, цвет подбирается
+    find_closest_colors_hybrid по всему каталогу. Поэтому результат отличается
+    от точного гибридного алгоритма, только когда найденный им цвет не вошел
+    в k соседей.
+
+    workers > 1 (или -1 - по числу ядер) делит большие наборы цветов между
+    потоками: k-d дерево и NumPy освобождают GIL, а каталог не копируется.
+
+    Возвращает пару массивов (M,): индексы найденных цветов в каталоге
+    и их dE2000, или (None, None), если каталог пуст.
+    """
+    lab_array = color_catalog["lab"]
+    if len(lab_array) == 0:
+        return None, None
+
+    target_labs = np.asarray(target_labs, dtype=np.float64).reshape(-1, 3)
+
+    if workers == -1:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(target_labs) >= _PARALLEL_MIN_TARGETS:
+        chunks = np.array_split(target_labs, workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda chunk: find_closest_colors_kdtree(chunk, color_catalog, k, lightness_tolerance),
+                chunks))
+        return (np.concatenate([idxs for idxs, _ in results]),
+                np.concatenate([dists for _, dists in results]))
+
+    _, candidates = color_catalog["tree"].query(target_labs, k=min(k, len(lab_array)))
+    candidates = candidates.reshape(len(target_labs), -1)
+
+    # Матрица (M, k) расстояний одним вызовом для всех цветов
+    delta_e = color_catalog["kernel"](target_labs[:, None, :], candidates)
+
+    in_tolerance = np.abs(lab_array[candidates, 0] - target_labs[:, None, 0]) <= lightness_tolerance
+    delta_e = np.where(in_tolerance, delta_e, np.inf)
+
+    best = np.argmin(delta_e, axis=1)
+    rows = np.arange(len(target_labs))
+    idxs, dists = candidates[rows, best], delta_e[rows, best]
+
+    # Строки без соседей в допуске ищут точным гибридным алгоритмом по каталогу
+    fallback = ~in_tolerance.any(axis=1)
+    if fallback.any():
+        idxs[fallback], dists[fallback] = find_closest_colors_hybrid(
+            target_labs[fallback], color_catalog, lightness_tolerance)
+    return idxs, dists
+
+# Статические начало и конец страницы
+_HTML_HEADER = """
 <!DOCTYPE html>
 <html lang="ru">
 <head>
@@ -128,109 +643,227 @@ def generate_color_scale_html(ideal_scale, real_scale, filename="color_scale.htm
 </head>
 <body>
 """
-    html_content += generate_strip("Ideal Gradient (Interpolated)", ideal_scale)
-    html_content += generate_strip("Real Folio Colors (Closest Match)", real_scale)
-
-    html_content += """
+_HTML_FOOTER = """
 </body>
 </html>"""
+
+# Шаблоны одной цветовой полосы для str.format_map
+BAND_TEMPLATE = """
+            <div class="color-band" style="background-color: {hex}; color: {text};">
+                <div class="color-info">
+                    <p>LAB: {lab_l:.1f}, {lab_a:.1f}, {lab_b:.1f}</p><p>HSL: {hsl_h:.0f}°, {hsl_s:.0f}%, {hsl_l:.0f}%</p>{match_html}
+                </div>
+            </div>"""
+MATCH_TEMPLATE = "<p>Folio: {match_name}</p><p><small>dE2000: {delta_e:.2f}</small></p>"
+
+def _band_rows(scale_data):
+    """Готовит для каждой полосы плоский словарь значений для BAND_TEMPLATE."""
+    lab = np.array([item['lab'] for item in scale_data], dtype=np.float64).reshape(-1, 3)
+    # S и L в HSL выводятся в процентах
+    hsl = np.array([item['hsl'] for item in scale_data], dtype=np.float64).reshape(-1, 3) * [1, 100, 100]
+    text = np.where(lab[:, 0] > 60, "black", "white")
+
+    rows = []
+    for item, (lab_l, lab_a, lab_b), (hsl_h, hsl_s, hsl_l), text_color in zip(
+            scale_data, lab.tolist(), hsl.tolist(), text.tolist()):
+        rows.append({
+            "hex": item['hex'],
+            "text": text_color,
+            "lab_l": lab_l, "lab_a": lab_a, "lab_b": lab_b,
+            "hsl_h": hsl_h, "hsl_s": hsl_s, "hsl_l": hsl_l,
+            "match_html": MATCH_TEMPLATE.format_map(item) if 'match_name' in item else "",
+        })
+    return rows
+
+def generate_color_scale_html(ideal_scale, real_scale, filename="color_scale.html"):
+    """Генерирует HTML-файл для визуализации двух цветовых шкал."""
+    
+    def generate_strip(title, scale_data):
+        """Вспомогательная функция для генерации одной полосы градиента."""
+        bands = "".join(BAND_TEMPLATE.format_map(row) for row in _band_rows(scale_data))
+        return f"<h2>{title}</h2><div class='container'>{bands}</div>"
+
+    parts: list[str] = [_HTML_HEADER]
+    parts.append(generate_strip("Ideal Gradient (Interpolated)", ideal_scale))
+    parts.append(generate_strip("Real Folio Colors (Closest Match)", real_scale))
+    parts.append(_HTML_FOOTER)
     with open(filename, "w", encoding='utf-8') as f:
-        f.write(html_content)
+        f.write("".join(parts))
 
 
-def main():
+def linear_interpolate_gradient(start_lab, end_lab, num_points=10):
+    """Линейная интерполяция в LAB: массив (num_points, 3) от start_lab до end_lab."""
+    t = np.linspace(0, 1, num_points)[:, None]
+    return (1 - t) * np.asarray(start_lab, dtype=np.float64) + t * np.asarray(end_lab, dtype=np.float64)
+
+def generate_alternating_gradient(start_lab, end_lab, num_points=11, peak_chroma_boost=15.0):
     """
-    Главная функция для генерации градиентной шкалы по методу попеременных шагов
-    с нелинейной интерполяцией насыщенности.
+    Градиент по методу попеременных шагов с нелинейной интерполяцией
+    насыщенности: тон постоянный (средний), на нечетных шагах меняется L,
+    на четных - C с добавочной насыщенностью peak_chroma_boost в пике.
+
+    Возвращает массив LAB (num_points, 3).
+    """
+    # Конвертируем в LCH для работы с тоном, насыщенностью и светлотой
+    start_l, start_c, start_h = lab_to_lch(start_lab).tolist()
+    end_l, end_c, end_h = lab_to_lch(end_lab).tolist()
+
+    # Рассчитываем средний тон (с учетом "перехода через 0/360 градусов")
+    h1, h2 = start_h, end_h
+    avg_hue = (h1 + h2) / 2
+    if abs(h1 - h2) > 180:
+        avg_hue = (avg_hue + 180) % 360
+
+    # Сколько всего шагов для L
+    total_l_steps = (num_points - 1) // 2 + ((num_points - 1) % 2)
+    
+    l_step_size = (end_l - start_l) / total_l_steps if total_l_steps > 0 else 0
+
+    # Считаем все шаги градиента сразу, без пошагового цикла
+    steps = np.arange(num_points)
+
+    # Попеременно меняем L и C.
+    # Шаги 1, 3, 5... -> меняем L (накапливаем в том же порядке, что и по шагам)
+    l_increments = np.where((steps - 1) % 2 == 0, l_step_size, 0.0)
+    l_increments[0] = start_l
+    l_vals = np.add.accumulate(l_increments)
+
+    # Шаги 2, 4, 6... -> меняем C, до следующего изменения C не меняется.
+    # Для Хромы используем нелинейную интерполяцию для "сочности"
+    c_steps = steps // 2 * 2
+    t_c = c_steps / (num_points - 1)
+    linear_chroma = start_c + (end_c - start_c) * t_c
+    bulge = peak_chroma_boost * np.sin(np.pi * t_c)
+    c_vals = np.where(c_steps >= 2, linear_chroma + bulge, start_c)
+
+    h_vals = np.full(num_points, avg_hue)
+
+    # Гарантируем, что начальная и конечная точки соответствуют заданным
+    l_vals[0], c_vals[0], h_vals[0] = start_l, start_c, start_h
+    l_vals[-1], c_vals[-1], h_vals[-1] = end_l, end_c, end_h
+
+    h_rad = np.radians(h_vals)
+    return np.column_stack([l_vals, np.cos(h_rad) * c_vals, np.sin(h_rad) * c_vals])
+
+
+def match_unique_targets(match, target_labs, color_catalog, decimals=None):
+    """
+    Вызывает способ подбора match(target_labs, color_catalog) только для
+    различающихся целевых цветов и раскладывает результат обратно по всем M.
+    Если задано decimals, цвета перед сравнением округляются (например, до 0.1
+    при decimals=1), и для совпавших после округления ищется один общий цвет.
+    """
+    target_labs = np.asarray(target_labs, dtype=np.float64).reshape(-1, 3)
+    keys = target_labs if decimals is None else np.round(target_labs, decimals)
+    unique_labs, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if len(unique_labs) == len(target_labs):
+        return match(target_labs, color_catalog)
+
+    if decimals is None:
+        representatives = unique_labs
+    else:
+        # Ищем по первому исходному цвету из каждой группы, а не по округленному
+        first = np.full(len(unique_labs), len(target_labs))
+        np.minimum.at(first, inverse, np.arange(len(target_labs)))
+        representatives = target_labs[first]
+
+    idxs, des = match(representatives, color_catalog)
+    if idxs is None:
+        return None, None
+    return idxs[inverse], des[inverse]
+
+def match_kdtree(target_labs, color_catalog):
+    """Быстрый подбор по кандидатам из k-d дерева (см. find_closest_colors_kdtree)."""
+    return find_closest_colors_kdtree(target_labs, color_catalog, lightness_tolerance=5.0, workers=-1)
+
+def match_hybrid(target_labs, color_catalog):
+    """Точный подбор по всему каталогу (см. find_closest_colors_hybrid)."""
+    return find_closest_colors_hybrid(target_labs, color_catalog, lightness_tolerance=5.0)
+
+# Способы подбора реальных цветов для набора целевых цветов (M, 3)
+MATCHERS = {
+    "kdtree": match_kdtree,
+    "hybrid": match_hybrid,
+}
+
+# Способы построения идеального градиента (start_lab, end_lab, num_points) -> (num_points, 3)
+GRADIENTS = {
+    "alternating": generate_alternating_gradient,
+    "linear": linear_interpolate_gradient,
+}
+
+def main(matcher="kdtree", gradient="alternating", decimals=None):
+    """
+    Главная функция для генерации градиентной шкалы. По умолчанию - по методу
+    попеременных шагов с нелинейной интерполяцией насыщенности.
+
+    matcher - способ подбора цветов из MATCHERS: "kdtree" (быстрый, по
+    кандидатам из k-d дерева) или "hybrid" (точный, по всему каталогу).
+    gradient - способ построения идеального градиента из GRADIENTS:
+    "alternating" (попеременные шаги L и C) или "linear" (линейно в LAB).
+    decimals - если задано, шаги, совпадающие после округления LAB до этого
+    числа знаков, подбираются один раз (см. match_unique_targets).
     """
     excel_file = '27.06.2025г. Каталог Folio (составы) .xlsx'
     
     color_catalog = extract_colors_from_excel(excel_file)
     
-    if not color_catalog:
+    if not color_catalog["names"]:
         print("Не удалось извлечь цвета из каталога. Завершение работы.")
         return
 
     # Крайние точки из задания
-    start_lab = LabColor(22.260, 3.294, -5.936)
-    end_lab = LabColor(92.5239, 1.0497, -1.8174)
+    start_lab = (22.260, 3.294, -5.936)
+    end_lab = (92.5239, 1.0497, -1.8174)
     
-    # Конвертируем в LCH для работы с тоном, насыщенностью и светлотой
-    start_lch = convert_color(start_lab, LCHabColor)
-    end_lch = convert_color(end_lab, LCHabColor)
-
-    # Рассчитываем средний тон (с учетом "перехода через 0/360 градусов")
-    h1, h2 = start_lch.lch_h, end_lch.lch_h
-    avg_hue = (h1 + h2) / 2
-    if abs(h1 - h2) > 180:
-        avg_hue = (avg_hue + 180) % 360
-
     num_points = 11
     ideal_color_scale = []
     real_color_scale = []
-    
-    peak_chroma_boost = 15.0 # Добавочная насыщенность в пике
 
-    l_val, c_val = start_lch.lch_l, start_lch.lch_c
-    
-    # Сколько всего шагов для L и C
-    total_l_steps = (num_points - 1) // 2 + ((num_points - 1) % 2)
-    total_c_steps = (num_points - 1) // 2
-    
-    l_step_size = (end_lch.lch_l - start_lch.lch_l) / total_l_steps if total_l_steps > 0 else 0
-    
-    for i in range(num_points):
-        t = i / (num_points - 1)
-        
-        if i > 0:
-            # Попеременно меняем L и C
-            if (i - 1) % 2 == 0:  # Шаги 1, 3, 5... -> меняем L
-                l_val += l_step_size
-            else:  # Шаги 2, 4, 6... -> меняем C
-                # Для Хромы используем нелинейную интерполяцию для "сочности"
-                linear_chroma = start_lch.lch_c + (end_lch.lch_c - start_lch.lch_c) * t
-                bulge = peak_chroma_boost * np.sin(np.pi * t)
-                c_val = linear_chroma + bulge
-        
-        # Гарантируем, что начальная и конечная точки соответствуют заданным
-        if i == 0:
-            gen_lch = start_lch
-        elif i == num_points - 1:
-            gen_lch = end_lch
-        else:
-            gen_lch = LCHabColor(l_val, c_val, avg_hue)
-        
-        gen_lab = convert_color(gen_lch, LabColor)
-        
+    gen_labs = GRADIENTS[gradient](start_lab, end_lab, num_points)
+
+    # Ищем ближайшие реальные цвета по гибридному методу для всех шагов сразу
+    closest_idxs, closest_delta_e = match_unique_targets(
+        MATCHERS[matcher], gen_labs, color_catalog, decimals=decimals)
+
+    for i, gen_lab_arr in enumerate(gen_labs):
         # Добавляем теоретический цвет в шкалу
-        ideal_rgb = get_rgb_from_lab(gen_lab)
-        ideal_hsl = get_hsl_from_lab(gen_lab)
         ideal_color_scale.append({
             "step": i + 1,
-            "lab": gen_lab,
-            "rgb": ideal_rgb,
-            "hsl": ideal_hsl
+            "lab": tuple(gen_lab_arr.tolist()),
         })
 
-        # Ищем ближайший реальный цвет по гибридному методу
-        closest_match = find_closest_color_hybrid(gen_lab, color_catalog, lightness_tolerance=5.0)
-        
-        if closest_match:
-            closest_rgb = get_rgb_from_lab(closest_match['lab'])
-            closest_hsl = get_hsl_from_lab(closest_match['lab'])
-            delta_e = delta_e_cie2000(gen_lab, closest_match['lab'])
+        if closest_idxs is not None:
+            closest_idx = closest_idxs[i]
+            closest_lab_arr = color_catalog["lab"][closest_idx]
             real_color_scale.append({
                 "step": i + 1,
-                "lab": closest_match['lab'],
-                "rgb": closest_rgb,
-                "hsl": closest_hsl,
-                "match_name": closest_match['name'],
-                "delta_e": delta_e
+                "lab": catalog_lab_values(closest_lab_arr),
+                "match_name": color_catalog["names"][closest_idx],
+                "delta_e": float(closest_delta_e[i])
             })
 
+    # RGB и HSL для обеих шкал считаем одним вызовом
+    all_items = ideal_color_scale + real_color_scale
+    summary = lab_summary([item['lab'] for item in all_items])
+    for item, rgb, hex_color, hsl in zip(all_items, summary["rgb"].tolist(), summary["hex"], summary["hsl"]):
+        item['rgb'] = tuple(rgb)
+        item['hex'] = hex_color
+        item['hsl'] = hsl
+
     generate_color_scale_html(ideal_color_scale, real_color_scale, "index.html")
     print("Генерация index.html завершена.")
 
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Генерация index.html с градиентной шкалой и ближайшими цветами Folio.")
+    parser.add_argument("--matcher", choices=sorted(MATCHERS), default="kdtree",
+                        help="способ подбора реальных цветов (по умолчанию kdtree)")
+    parser.add_argument("--gradient", choices=sorted(GRADIENTS), default="alternating",
+                        help="способ построения идеального градиента (по умолчанию alternating)")
+    parser.add_argument("--round", type=int, default=None, metavar="DECIMALS", dest="decimals",
+                        help="подбирать один раз шаги, совпадающие после округления LAB "
+                             "до DECIMALS знаков (по умолчанию - только точные повторы)")
+    args = parser.parse_args()
+    main(matcher=args.matcher, gradient=args.gradient, decimals=args.decimals) 
\ No newline at end of file